@@ -15,46 +15,66 @@ def read_file_list(filename):
     filename -- File name
     
     Output:
-    dict -- dictionary of (stamp,data) tuples
+    stamps -- sorted array of distinct time stamps (for a repeated stamp, the last line wins)
+    data -- list with the data (list of strings) of every time stamp
     """
     with open(filename) as file:
         data = file.read()
     lines = data.replace(",", " ").replace("\t", " ").split("\n")
     file_list = [[v.strip() for v in line.split(" ") if v.strip() != ""] for line in lines if len(line) > 0 and line[0] != "#"]
-    file_list = [(float(l[0]), l[1:]) for l in file_list if len(l) > 1]
-    return dict(file_list)
+    file_list = [l for l in file_list if len(l) > 1]
+    stamps = numpy.array([l[0] for l in file_list], dtype=float)
+    order = numpy.argsort(stamps, kind="stable")
+    stamps = stamps[order]
+    last = numpy.ones(len(stamps), dtype=bool)
+    last[:-1] = stamps[1:] != stamps[:-1]
+    order, stamps = order[last], stamps[last]
+    data = [file_list[i][1:] for i in order.tolist()]
+    return stamps, data
 
 
 def associate(first_list, second_list, offset, max_difference):
     """
-    Associate two dictionaries of (stamp, data). As the time stamps never match exactly, we aim 
-    to find the closest match for every input tuple.
+    Associate two lists of time stamps. As the time stamps never match exactly, we aim 
+    to find the closest match for every input stamp.
     
     Input:
-    first_list -- first dictionary of (stamp, data) tuples
-    second_list -- second dictionary of (stamp, data) tuples
-    offset -- time offset between both dictionaries (e.g., to model the delay between the sensors)
+    first_list -- first array of stamps
+    second_list -- second array of stamps
+    offset -- time offset between both lists (e.g., to model the delay between the sensors)
     max_difference -- search radius for candidate generation
 
     Output:
-    matches -- list of matched tuples ((stamp1, data1), (stamp2, data2))
+    matches -- list of matched (stamp1, stamp2) tuples, sorted by stamp1
     """
-    first_keys = set(first_list.keys())
-    second_keys = set(second_list.keys())
-
-    potential_matches = [(abs(a - (b + offset)), a, b) 
-                         for a in first_keys 
-                         for b in second_keys 
-                         if abs(a - (b + offset)) < max_difference]
-    potential_matches.sort()
-    matches = []
-    for diff, a, b in potential_matches:
-        if a in first_keys and b in second_keys:
-            first_keys.remove(a)
-            second_keys.remove(b)
-            matches.append((a, b))
-    
-    matches.sort()
+    # Sorted, distinct stamps: a stamp that occurs twice can still only be matched once
+    first_keys = numpy.unique(numpy.asarray(first_list, dtype=float))
+    second_keys = numpy.unique(numpy.asarray(second_list, dtype=float))
+
+    # Candidates for a are the second stamps inside (a - offset) +/- max_difference
+    lo = numpy.searchsorted(second_keys, first_keys - offset - max_difference, side="left")
+    hi = numpy.searchsorted(second_keys, first_keys - offset + max_difference, side="right")
+    counts = hi - lo
+    a = numpy.repeat(numpy.arange(len(first_keys)), counts)
+    starts = numpy.repeat(lo - (numpy.cumsum(counts) - counts), counts)
+    b = starts + numpy.arange(len(a))
+    diff = numpy.abs(first_keys[a] - (second_keys[b] + offset))
+    keep = diff < max_difference
+    a, b, diff = a[keep], b[keep], diff[keep]
+    order = numpy.lexsort((b, a, diff))
+
+    # Greedily claim the candidate pairs in order of increasing difference
+    partner = [-1] * len(first_keys)
+    second_taken = [False] * len(second_keys)
+    for i, j in zip(a[order].tolist(), b[order].tolist()):
+        if partner[i] < 0 and not second_taken[j]:
+            partner[i] = j
+            second_taken[j] = True
+
+    # first_keys is sorted, so the matches come out in ascending order of the first stamp
+    first_stamps = first_keys.tolist()
+    second_stamps = second_keys.tolist()
+    matches = [(first_stamps[i], second_stamps[j]) for i, j in enumerate(partner) if j >= 0]
     return matches
 
 
@@ -69,35 +89,42 @@ if __name__ == '__main__':
     max_difference = 0.02  # Maximum time difference for matching
 
     # Read the files
-    depth_list = read_file_list(depth_file)
-    rgb_list = read_file_list(rgb_file)
-    groundtruth_list = read_file_list(groundtruth_file)
+    depth_stamps, depth_data = read_file_list(depth_file)
+    rgb_stamps, rgb_data = read_file_list(rgb_file)
+    gt_stamps, gt_data = read_file_list(groundtruth_file)
 
     # Associate the depth, rgb, and groundtruth files
-    depth_rgb_matches = associate(depth_list, rgb_list, offset, max_difference)
-    depth_gt_matches = associate(depth_list, groundtruth_list, offset, max_difference)
+    depth_rgb_matches = associate(depth_stamps, rgb_stamps, offset, max_difference)
+    depth_gt_matches = associate(depth_stamps, gt_stamps, offset, max_difference)
     print(f"Found {len(depth_rgb_matches)} depth-rgb matches and {len(depth_gt_matches)} depth-groundtruth matches")
 
     # List to store matches for depth, rgb, and groundtruth
     depth_rgb_gt_matches = []
 
-    # Match depth-rgb with groundtruth
+    # Match depth-rgb with groundtruth through the groundtruth stamp associated with each depth stamp
+    depth_to_gt = dict(depth_gt_matches)
     for depth_stamp, rgb_stamp in depth_rgb_matches:
-        for _, gt_stamp in depth_gt_matches:
-            if abs(rgb_stamp - gt_stamp) < max_difference:  # Ensure the rgb_stamp also matches a groundtruth timestamp
-                depth_rgb_gt_matches.append((depth_stamp, rgb_stamp, gt_stamp))
-                break  # Found a match, no need to check further for this depth_stamp
+        gt_stamp = depth_to_gt.get(depth_stamp)
+        if gt_stamp is not None:
+            depth_rgb_gt_matches.append((depth_stamp, rgb_stamp, gt_stamp))
+
+    # Find the data rows of all matched stamps in the sorted stamp arrays
+    matched_stamps = numpy.array(depth_rgb_gt_matches, dtype=float).reshape(-1, 3)
+    depth_rows = numpy.searchsorted(depth_stamps, matched_stamps[:, 0]).tolist()
+    rgb_rows = numpy.searchsorted(rgb_stamps, matched_stamps[:, 1]).tolist()
+    gt_rows = numpy.searchsorted(gt_stamps, matched_stamps[:, 2]).tolist()
 
     # Prepare the output with data
     output_lines = []
-    for depth_stamp, rgb_stamp, gt_stamp in depth_rgb_gt_matches:
+    for (depth_stamp, rgb_stamp, gt_stamp), depth_row, rgb_row, gt_row in zip(
+            depth_rgb_gt_matches, depth_rows, rgb_rows, gt_rows):
         # Retrieve the data for each timestamp
-        depth_data = " ".join(depth_list[depth_stamp])
-        rgb_data = " ".join(rgb_list[rgb_stamp])
-        gt_data = " ".join(groundtruth_list[gt_stamp])
+        depth_line = " ".join(depth_data[depth_row])
+        rgb_line = " ".join(rgb_data[rgb_row])
+        gt_line = " ".join(gt_data[gt_row])
         
         # Create a line with timestamp and data for depth, rgb, and groundtruth
-        output_lines.append(f"{depth_stamp} {depth_data} {rgb_stamp} {rgb_data} {gt_stamp} {gt_data}\n")
+        output_lines.append(f"{depth_stamp} {depth_line} {rgb_stamp} {rgb_line} {gt_stamp} {gt_line}\n")
 
     print("Output line: ", len(output_lines))
     # Save the output to a file
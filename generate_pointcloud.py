@@ -1,9 +1,16 @@
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import math
 from PIL import Image
 import numpy as np
-from scipy.spatial.transform import Rotation as R
+
+try:
+    from numba import njit, prange
+except ImportError:  # Numba is optional, the NumPy code path is used without it
+    njit = None
 
 # Camera parameters
 focalLength = 525.0
@@ -14,29 +21,141 @@ scalingFactor = 5000.0
 # Input and output configuration (hardcoded)
 file_list = "timestamp_map.txt"  # Path to the input file
 output_dir = Path("output_ply")  # Directory where PLY files will be saved
+frames_per_task = 8  # Number of consecutive frames each worker process pipelines at a time
+binary_ply = True  # Write PLY files as binary_little_endian instead of ASCII
+ply_alpha = False  # Also write an (always 0) alpha channel, for tools that expect RGBA vertices
+
+# Vertex layout of the binary PLY files (matches the header returned by ply_header)
+ply_vertex_dtype = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4"),
+                             ("red", "u1"), ("green", "u1"), ("blue", "u1")]
+                            + ([("alpha", "u1")] if ply_alpha else []))
+
+# Raw pixel layout of the PIL depth image modes, used to wrap tobytes() without conversion
+depth_mode_dtypes = {"I;16": "<u2", "I;16L": "<u2", "I;16B": ">u2", "I;16N": "=u2", "I": "=i4"}
 
 # Define a function to convert quaternion to rotation matrix
 def quaternion_to_rotation_matrix(qx, qy, qz, qw):
     """
-    Convert quaternion to a rotation matrix.
+    Convert quaternion (scalar-last, not necessarily normalized) to a rotation matrix.
     """
-    r = R.from_quat([qx, qy, qz, qw])
-    return r.as_matrix()
+    n = qx * qx + qy * qy + qz * qz + qw * qw
+    s = 2.0 / n
+    x, y, z = qx * s, qy * s, qz * s
+    wx, wy, wz = qw * x, qw * y, qw * z
+    xx, xy, xz = qx * x, qx * y, qx * z
+    yy, yz, zz = qy * y, qy * z, qz * z
+    return np.array([[1.0 - (yy + zz), xy - wz, xz + wy],
+                     [xy + wz, 1.0 - (xx + zz), yz - wx],
+                     [xz - wy, yz + wx, 1.0 - (xx + yy)]], dtype=np.float64)
 
-# Apply transformation using the quaternion and translation
-def apply_transformation(x, y, z, rotation_matrix, translation):
+# Ray direction tables: the intrinsics are constant, so (u - cx) / f and (v - cy) / f only depend on the image size
+@lru_cache(maxsize=None)
+def ray_tables(height, width):
     """
-    Apply translation and rotation to a 3D point.
+    Return the per-column (u - centerX) / focalLength and per-row (v - centerY) / focalLength factors.
     """
-    point = np.array([x, y, z])
-    transformed_point = np.dot(rotation_matrix, point) + translation
-    return transformed_point  # Return the transformed x, y, z components
+    ux = ((np.arange(width) - centerX) / focalLength).astype(np.float32)
+    vy = ((np.arange(height) - centerY) / focalLength).astype(np.float32)
+    return ux, vy
 
-# Generate point cloud in PLY format from RGB and Depth images
-def generate_pointcloud(rgb_file, depth_file, ply_file, tx, ty, tz, qx, qy, qz, qw):
+# Work buffers of the point cloud computation, keyed by (height, width, slot) and reused across frames
+_frame_buffers = {}
+
+def frame_buffers(height, width, slot=0):
     """
-    Generate a colored point cloud in PLY format from color and depth images
-    with transformation applied using quaternion and translation.
+    Return the work buffers for a height x width frame, allocating them on first use.
+    Every slot has its own set, so one frame can be computed while the vertices of the
+    previous one (in another slot) are still being written.
+    """
+    key = (height, width, slot)
+    if key not in _frame_buffers:
+        size = height * width
+        buffers = {}
+        if binary_ply:
+            buffers["vertices"] = np.empty(size, dtype=ply_vertex_dtype)
+        if not binary_ply or build_ply is None:
+            ux, vy = ray_tables(height, width)
+            buffers["ux"] = np.broadcast_to(ux[np.newaxis, :], (height, width)).reshape(-1)
+            buffers["vy"] = np.broadcast_to(vy[:, np.newaxis], (height, width)).reshape(-1)
+            buffers["mask"] = np.empty((height, width), dtype=bool)
+            buffers["points"] = np.empty((size, 3), dtype=np.float32)
+            buffers["transformed"] = np.empty((size, 3), dtype=np.float32)
+            buffers["colors"] = np.empty((size, 3), dtype=np.uint8)
+            if not binary_ply:
+                buffers["vertex_data"] = np.empty((size, 6), dtype=np.float32)
+        _frame_buffers[key] = buffers
+    return _frame_buffers[key]
+
+# Build the PLY header shared by the ASCII and binary writers
+def ply_header(ply_format, vertex_count):
+    """
+    Return the PLY header for vertex_count vertices stored as ply_format ("ascii" or "binary_little_endian").
+    """
+    alpha = "property uchar alpha\n" if ply_alpha else ""
+    return f'''ply
+format {ply_format} 1.0
+element vertex {vertex_count}
+property float x
+property float y
+property float z
+property uchar red
+property uchar green
+property uchar blue
+{alpha}end_header
+'''
+
+# Fused point cloud kernel: back-project, transform and pack every pixel in a single pass
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def build_ply(depth, rgb, rotation_matrix, translation, ux, vy, inv_scale, out):
+        """
+        Write the transformed, colored vertices of all pixels with positive depth into the
+        structured array out (ply_vertex_dtype, at least H*W long) and return their count.
+        """
+        height, width = depth.shape
+
+        # Count the valid pixels of every row first so each row knows where its output starts
+        offsets = np.zeros(height + 1, dtype=np.int64)
+        for v in prange(height):
+            count = 0
+            for u in range(width):
+                if depth[v, u] > 0:
+                    count += 1
+            offsets[v + 1] = count
+        offsets = np.cumsum(offsets)
+
+        for v in prange(height):
+            k = offsets[v]
+            for u in range(width):
+                if depth[v, u] <= 0:
+                    continue
+                Z = np.float32(depth[v, u]) * inv_scale
+                X = ux[u] * Z
+                Y = vy[v] * Z
+                vertex = out[k]
+                vertex["x"] = rotation_matrix[0, 0] * X + rotation_matrix[0, 1] * Y + rotation_matrix[0, 2] * Z + translation[0]
+                vertex["y"] = rotation_matrix[1, 0] * X + rotation_matrix[1, 1] * Y + rotation_matrix[1, 2] * Z + translation[1]
+                vertex["z"] = rotation_matrix[2, 0] * X + rotation_matrix[2, 1] * Y + rotation_matrix[2, 2] * Z + translation[2]
+                vertex["red"] = rgb[v, u, 0]
+                vertex["green"] = rgb[v, u, 1]
+                vertex["blue"] = rgb[v, u, 2]
+                k += 1
+        return offsets[height]
+
+    # Single-threaded variant for the frame pool workers (see _init_worker). prange runs as a plain
+    # range here. It is not cached on disk, so it cannot share a cache entry with the parallel kernel.
+    build_ply_serial = njit(build_ply.py_func)
+else:
+    build_ply = build_ply_serial = None
+
+# Whether to run the parallel Numba kernel; switched off in the frame pool workers
+_parallel_kernel = True
+
+# Load the color and depth images of a frame as NumPy arrays
+def load_images(rgb_file, depth_file):
+    """
+    Decode the color and depth images and return them as (rgb_arr, depth_raw) arrays of shape
+    (height, width, 3) and (height, width), with depth in raw sensor units.
     """
     rgb = Image.open(rgb_file)
     depth = Image.open(depth_file)
@@ -47,73 +166,190 @@ def generate_pointcloud(rgb_file, depth_file, ply_file, tx, ty, tz, qx, qy, qz,
         raise Exception(f"Color image is not in RGB format: {rgb_file}")
     if depth.mode[0] != "I":
         raise Exception(f"Depth image is not in intensity format: {depth_file}")
-    
-    # Convert quaternion to rotation matrix
-    rotation_matrix = quaternion_to_rotation_matrix(qx, qy, qz, qw)
-    translation = np.array([tx, ty, tz])
-
-    points = []
-    for v in range(rgb.size[1]):
-        for u in range(rgb.size[0]):
-            color = rgb.getpixel((u, v))
-            Z = depth.getpixel((u, v)) / scalingFactor
-            if Z == 0: 
-                continue
-            X = (u - centerX) * Z / focalLength
-            Y = (v - centerY) * Z / focalLength
-
-            # Apply the transformation (rotation + translation)
-            transformed_point = apply_transformation(X, Y, Z, rotation_matrix, translation)
-
-            points.append(f"{transformed_point[0]} {transformed_point[1]} {transformed_point[2]} {color[0]} {color[1]} {color[2]} 0\n")
-    print(len(points), len(points[0]))
-    print("---------------------------------------------")
-    
-    with open(ply_file, "w") as file:
-        file.write(f'''ply
-format ascii 1.0
-element vertex {len(points)}
-property float x
-property float y
-property float z
-property uchar red
-property uchar green
-property uchar blue
-property uchar alpha
-end_header
-{''.join(points)}
-''')
+
+    # Wrap the raw image buffers directly instead of going through PIL's array interface
+    width, height = depth.size
+    if depth.mode in depth_mode_dtypes:
+        depth_raw = np.frombuffer(depth.tobytes(), dtype=depth_mode_dtypes[depth.mode]).reshape(height, width)
+    else:
+        depth_raw = np.asarray(depth)
+    if not depth_raw.dtype.isnative:
+        depth_raw = depth_raw.astype(depth_raw.dtype.newbyteorder("="))
+    rgb_arr = np.frombuffer(rgb.tobytes(), dtype=np.uint8).reshape(height, width, 3)
+    return rgb_arr, depth_raw
+
+# Back-project and transform the pixels of a frame into PLY vertices
+def compute_vertices(rgb_arr, depth_raw, tx, ty, tz, qx, qy, qz, qw, slot=0):
+    """
+    Return the transformed, colored vertices of all pixels with a depth value: a ply_vertex_dtype
+    array when writing binary PLY files, otherwise an N x 6 array of x, y, z, red, green, blue.
+    The result is a view into the frame buffers of the given slot and is only valid until the
+    next frame is computed in that slot.
+    """
+    # Convert quaternion to rotation matrix. The vertices are stored as float32, so all geometry is
+    # computed in single precision to halve the memory traffic of the kernel.
+    rotation_matrix = quaternion_to_rotation_matrix(qx, qy, qz, qw).astype(np.float32)
+    translation = np.asarray([tx, ty, tz], dtype=np.float32)
+    inv_scale = np.float32(1.0 / scalingFactor)
+
+    height, width = depth_raw.shape
+    buffers = frame_buffers(height, width, slot)
+    if binary_ply and build_ply is not None:
+        ux, vy = ray_tables(height, width)
+        kernel = build_ply if _parallel_kernel else build_ply_serial
+        count = kernel(depth_raw, rgb_arr, rotation_matrix, translation,
+                       ux, vy, inv_scale, buffers["vertices"])
+        vertices = buffers["vertices"][:count]
+    else:
+        # Select the pixels with a depth value first, so only those are scaled, back-projected and transformed
+        mask = np.greater(depth_raw, 0, out=buffers["mask"]).reshape(-1)
+        idx = np.flatnonzero(mask)
+        count = len(idx)
+        P = buffers["points"][:count]
+        np.multiply(depth_raw.reshape(-1)[idx], inv_scale, out=P[:, 2])
+        np.take(buffers["ux"], idx, out=P[:, 0])
+        np.take(buffers["vy"], idx, out=P[:, 1])
+        P[:, :2] *= P[:, 2:]
+        colors = np.take(rgb_arr.reshape(-1, 3), idx, axis=0, out=buffers["colors"][:count])
+
+        # Apply the transformation (rotation + translation) to all points in one matrix product
+        transformed_points = np.dot(P, rotation_matrix.T, out=buffers["transformed"][:count])
+        transformed_points += translation
+
+        if not binary_ply:
+            vertex_data = buffers["vertex_data"][:count]
+            vertex_data[:, :3] = transformed_points
+            vertex_data[:, 3:] = colors
+            return vertex_data
+
+        vertices = buffers["vertices"][:count]
+        vertices["x"] = transformed_points[:, 0]
+        vertices["y"] = transformed_points[:, 1]
+        vertices["z"] = transformed_points[:, 2]
+        vertices["red"] = colors[:, 0]
+        vertices["green"] = colors[:, 1]
+        vertices["blue"] = colors[:, 2]
+
+    if ply_alpha:
+        vertices["alpha"] = 0
+    return vertices
+
+# Write the vertices returned by compute_vertices to a PLY file
+def write_ply(ply_file, vertices):
+    """
+    Write the vertices to ply_file in binary or ASCII PLY format, depending on binary_ply.
+    """
+    if binary_ply:
+        print(len(vertices), vertices.itemsize)
+        print("---------------------------------------------")
+
+        with open(ply_file, "wb") as file:
+            file.write(ply_header("binary_little_endian", len(vertices)).encode("ascii"))
+            vertices.tofile(file)
+    else:
+        print(len(vertices), vertices.shape[1])
+        print("---------------------------------------------")
+
+        # Let np.savetxt format the vertices with a fixed %g format instead of building an f-string per point
+        with open(ply_file, "w") as file:
+            file.write(ply_header("ascii", len(vertices)))
+            np.savetxt(file, vertices, fmt="%g %g %g %d %d %d" + (" 0" if ply_alpha else ""))
+
+# Generate point cloud in PLY format from RGB and Depth images
+def generate_pointcloud(rgb_file, depth_file, ply_file, tx, ty, tz, qx, qy, qz, qw):
+    """
+    Generate a colored point cloud in PLY format from color and depth images
+    with transformation applied using quaternion and translation.
+    """
+    rgb_arr, depth_raw = load_images(rgb_file, depth_file)
+    vertices = compute_vertices(rgb_arr, depth_raw, tx, ty, tz, qx, qy, qz, qw)
+    write_ply(ply_file, vertices)
+
+# Generate the point clouds for a chunk of frames (runs in a worker process)
+def _work(jobs):
+    """
+    Generate the PLY files of a list of (rgb_file, depth_file, ply_file, tx, ty, tz, qx, qy, qz, qw) jobs.
+    The images of the next frame are decoded and the PLY file of the previous frame is written in
+    background threads while the current frame is computed.
+    """
+    with ThreadPoolExecutor(max_workers=1) as loader, ThreadPoolExecutor(max_workers=1) as writer:
+        next_images = loader.submit(load_images, jobs[0][0], jobs[0][1])
+        last_write = None
+        for i, (rgb_file, depth_file, ply_file, *pose) in enumerate(jobs):
+            rgb_arr, depth_raw = next_images.result()
+            if i + 1 < len(jobs):
+                next_images = loader.submit(load_images, jobs[i + 1][0], jobs[i + 1][1])
+
+            print(f"Processing Depth: {depth_file}, RGB: {rgb_file} -> PLY: {ply_file}")
+            # Alternate between two buffer slots: the previous frame's vertices may still be being written
+            vertices = compute_vertices(rgb_arr, depth_raw, *pose, slot=i % 2)
+
+            if last_write is not None:
+                last_write.result()
+            last_write = writer.submit(write_ply, ply_file, vertices)
+        last_write.result()
+
+# Set up a worker process of the frame pool
+def _init_worker():
+    """
+    Use the single-threaded Numba kernel in pool workers. The pool already runs one worker per core,
+    so a parallel kernel in every worker would start cores^2 threads and oversubscribe the CPU.
+    It also keeps Numba's threading layer, which is not fork-safe, out of the forked workers.
+    Calls to generate_pointcloud outside the pool keep the parallel kernel.
+    """
+    global _parallel_kernel
+    _parallel_kernel = False
+
+# Read the file list in chunks of jobs
+def read_job_chunks(file_list, output_dir):
+    """
+    Stream the input file and yield lists of up to frames_per_task
+    (rgb_file, depth_file, ply_file, tx, ty, tz, qx, qy, qz, qw) jobs.
+    """
+    point_cloud_count = 0
+    with open(file_list, "r") as f:
+        while True:
+            jobs = []
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                parts = line.split()
+                if len(parts) != 12:
+                    raise ValueError(f"Unexpected format in line: {line}")
+
+                # Resolve file paths
+                depth_file = Path(parts[1])
+                rgb_file = Path(parts[3])
+                ply_file = output_dir / f"point_cloud{point_cloud_count}.ply"
+                tx, ty, tz, qx, qy, qz, qw = map(float, parts[5:12])
+
+                jobs.append((rgb_file, depth_file, ply_file, tx, ty, tz, qx, qy, qz, qw))
+                point_cloud_count += 1
+                if len(jobs) == frames_per_task:
+                    break
+            if not jobs:
+                return
+            yield jobs
 
 # Process the file list and generate point clouds for each pair
 def process_file_list(file_list, output_dir):
     """
     Process each line of the input file and generate PLY files for RGB and depth image pairs.
+    Frames are independent, so chunks of frames are processed concurrently in a pool of worker processes,
+    starting as soon as the first chunk has been read.
+    At most 2 chunks per worker are in flight, so memory does not grow with the length of the file list.
     """
-    with open(file_list, "r") as f:
-        lines = f.readlines()
-    
-    point_cloud_count = 0
-    for line in lines:
-        if not line.strip():
-            continue
-        parts = line.strip().split()
-        if len(parts) != 12:
-            raise ValueError(f"Unexpected format in line: {line}")
-        
-        # Extract data from each line
-        depth_file = parts[1]
-        rgb_file = parts[3]
-        tx, ty, tz = float(parts[5]), float(parts[6]), float(parts[7])
-        qx, qy, qz, qw = float(parts[8]), float(parts[9]), float(parts[10]), float(parts[11])
-
-        # Resolve file paths
-        depth_file = Path(depth_file)
-        rgb_file = Path(rgb_file)
-        ply_file = output_dir / f"point_cloud{point_cloud_count}.ply"
-        
-        print(f"Processing Depth: {depth_file}, RGB: {rgb_file} -> PLY: {ply_file}")
-        generate_pointcloud(rgb_file, depth_file, ply_file, tx, ty, tz, qx, qy, qz, qw)
-        point_cloud_count += 1
+    max_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+        futures = deque()
+        for jobs in read_job_chunks(file_list, output_dir):
+            # Wait on the oldest chunk before reading more of the file
+            if len(futures) == 2 * max_workers:
+                futures.popleft().result()
+            futures.append(executor.submit(_work, jobs))
+        for future in futures:
+            future.result()
 
 if __name__ == "__main__":
     # Create output directory if it does not exist
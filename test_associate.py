@@ -0,0 +1,55 @@
+import numpy
+
+from associate import associate
+
+
+def greedy_associate(first_stamps, second_stamps, offset, max_difference):
+    """
+    Reference matcher: claim every candidate pair in order of increasing difference.
+    """
+    first_keys = set(first_stamps)
+    second_keys = set(second_stamps)
+    potential_matches = sorted((abs(a - (b + offset)), a, b)
+                               for a in first_keys
+                               for b in second_keys
+                               if abs(a - (b + offset)) < max_difference)
+    matches = []
+    for diff, a, b in potential_matches:
+        if a in first_keys and b in second_keys:
+            first_keys.remove(a)
+            second_keys.remove(b)
+            matches.append((a, b))
+    matches.sort()
+    return matches
+
+
+def chained_stamps(n, max_difference):
+    """
+    Interleaved first/second stamps whose gaps keep growing but all stay below max_difference,
+    so every stamp competes with both neighbours and each greedy claim depends on the previous one.
+    """
+    gaps = numpy.linspace(0.2, 0.9, 2 * n - 1) * max_difference
+    stamps = 1000.0 + numpy.concatenate([[0.0], numpy.cumsum(gaps)])
+    return stamps[0::2].tolist(), stamps[1::2].tolist()
+
+
+def test_associate_matches_greedy_on_random_stamps():
+    rng = numpy.random.default_rng(0)
+    for _ in range(200):
+        first = numpy.round(rng.random(rng.integers(0, 40)) * 10, 3).tolist()
+        second = numpy.round(rng.random(rng.integers(0, 40)) * 10, 3).tolist()
+        offset = rng.random() - 0.5
+        max_difference = rng.random()
+        assert associate(first, second, offset, max_difference) == \
+            greedy_associate(first, second, offset, max_difference)
+
+
+def test_associate_matches_greedy_on_chained_stamps():
+    first, second = chained_stamps(300, 0.02)
+    assert associate(first, second, 0, 0.02) == greedy_associate(first, second, 0, 0.02)
+    assert associate(second, first, 0, 0.02) == greedy_associate(second, first, 0, 0.02)
+
+
+def test_associate_empty_lists():
+    assert associate([], [1.0], 0, 0.1) == []
+    assert associate([1.0], [], 0, 0.1) == []